@@ -1,24 +1,75 @@
-import json
+import asyncio
+import base64
+import binascii
+import functools
+import hashlib
 import os
-import datetime
-from typing import List, Optional
-
+import urllib.parse
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+
+import asyncpg
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from pydantic import BaseModel
+from pydantic.dataclasses import dataclass
 from starlette.requests import Request
-from starlette.responses import Response
-from supabase import create_client, Client
+from starlette.background import BackgroundTask
+from starlette.responses import Response, StreamingResponse
 from fastapi import FastAPI
 
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+
+from postprocess import convert_date_ranges
 
 load_dotenv()
 
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
+db_url: str = os.environ.get("SUPABASE_DB_URL")
+
+# asyncpg pool of direct connections to the Postgres database, shared by all requests of the process
+db_pool: Optional[asyncpg.Pool] = None
+DB_POOL_MAX_SIZE = 20
+
+# cursor pagination needs the `query_history_cursor` database function, enable it with CURSOR_PAGINATION=true once
+# the function is deployed. It takes the arguments of `query_history_2` without `res_offset`, plus the sort key of the
+# last entry of the previous page, NULL for the first page, and must return
+#
+#     ... WHERE last_tal IS NULL
+#            OR (tal, prefix, asn, max_len) > (last_tal, last_prefix, last_asn, last_max_len)
+#         ORDER BY tal, prefix, asn, max_len
+#         LIMIT res_limit
+#
+# Until then, lookups are served from `query_history_2` with page numbers.
+cursor_pagination: bool = os.environ.get("CURSOR_PAGINATION", "").lower() in ("1", "true")
+
+# optional Redis cache for lookup responses, disabled when REDIS_URL is not set. The cache is best-effort, short
+# timeouts keep a slow or unreachable Redis from holding up lookups
+redis_url: Optional[str] = os.environ.get("REDIS_URL")
+redis: Optional[aioredis.Redis] = aioredis.from_url(
+    redis_url, socket_timeout=0.5, socket_connect_timeout=0.5
+) if redis_url else None
+# the backend refreshes ROAs data every 2 hours, cached responses expire at the same cadence
+CACHE_TTL = 7200
+
+# in-process cache of hot lookup responses in front of Redis, bounded by the total size of the cached bodies in bytes
+local_cache: TTLCache = TTLCache(maxsize=64 * 1024 * 1024, ttl=CACHE_TTL, getsizeof=len)
+# largest response body stored in the caches, bigger responses are only streamed
+CACHE_MAX_BODY_SIZE = 4 * 1024 * 1024
+
+# in-flight backend calls by cache key, see `coalesce`
+inflight: Dict[str, asyncio.Future] = {}
+
+# number of ROA entries encoded per chunk of a streamed lookup response
+STREAM_BATCH_SIZE = 500
 
 BASEURL = "https://api.roas.bgpkit.com/"
+LOOKUP_URL = BASEURL.rstrip("/") + "/lookup"
+
+# available trust anchor locators, in the order lookup results are sorted in
+TALS = ["afrinic", "apnic", "arin", "lacnic", "ripencc"]
 
 description = """
 
@@ -72,9 +123,93 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+@app.on_event("startup")
+async def open_db_pool():
+    global db_pool
+    db_pool = await asyncpg.create_pool(dsn=db_url, min_size=5, max_size=DB_POOL_MAX_SIZE, statement_cache_size=200)
+
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    await db_pool.close()
+    if redis is not None:
+        await redis.close()
+
+
+async def rpc(function: str, params: dict):
+    """
+    Call a Postgres database function and return its rows as decoded JSON, in the same shape as PostgREST's RPC
+    endpoint returns them.
+
+    Database errors, and arguments asyncpg rejects before sending them (e.g. integers out of range), are returned as
+    `{"message": ...}`, like PostgREST does.
+    """
+    args = ", ".join(f'"{name}" => ${i}' for i, name in enumerate(params, start=1))
+    # rows are aggregated to JSON on the database side, the query text only depends on the function and parameter
+    # names, so its prepared statement is reused from the connection's statement cache
+    query = f"SELECT coalesce(json_agg(t), '[]'::json) FROM {function}({args}) t"
+    try:
+        async with db_pool.acquire() as conn:
+            res = await conn.fetchval(query, *params.values())
+    except (asyncpg.PostgresError, ValueError) as e:
+        # arguments rejected on the client side raise asyncpg's client `DataError`, which is a `ValueError` (the
+        # `asyncpg.DataError` name is the server-side SQLSTATE class)
+        return {"message": str(e)}
+    return orjson.loads(res)
+
+
+def coalesce(key: str, fetch: Callable[[], Awaitable]) -> Awaitable:
+    """
+    Share one in-flight backend call between all concurrent callers asking for the same key.
+
+    The call runs as its own task, so a caller going away does not cancel it for the others. The result is shared by
+    all callers and must not be mutated.
+    """
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    return asyncio.shield(task)
 
 
-class Entry(BaseModel):
+async def redis_get(key: str) -> Optional[bytes]:
+    """
+    Read a cached response body from Redis. A disabled or failing Redis is treated as a cache miss.
+    """
+    if redis is None:
+        return None
+    try:
+        return await redis.get(key)
+    except (RedisError, asyncio.TimeoutError, OSError):
+        return None
+
+
+async def redis_set(key: str, body: bytes):
+    """
+    Store a response body in Redis for `CACHE_TTL` seconds. Failures are ignored, the response is cached best-effort.
+    """
+    if redis is None:
+        return
+    try:
+        await redis.set(key, body, ex=CACHE_TTL)
+    except (RedisError, asyncio.TimeoutError, OSError):
+        pass
+
+
+def cache_key(namespace: str, params: dict) -> str:
+    """
+    Build a cache key from the canonicalized request parameters.
+    """
+    digest = hashlib.blake2b(orjson.dumps(params, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+@dataclass(frozen=True)
+class Entry:
     tal: str
     prefix: str
     max_len: int
@@ -87,11 +222,13 @@ class Result(BaseModel):
     count: int
     next_page_num: Optional[int]
     next_page: Optional[str]
+    next_cursor: Optional[str]
     error: Optional[str]
     data: List[Entry]
 
 
-class FileEntry(BaseModel):
+@dataclass(frozen=True)
+class FileEntry:
     url: str
     tal: str
     file_date: str
@@ -103,29 +240,25 @@ class FilesResult(BaseModel):
     data: List[FileEntry]
 
 
-@app.get("/files", response_model=FilesResult, include_in_schema=False)
+@app.get("/files", responses={200: {"model": FilesResult}}, include_in_schema=False)
 async def files(request: Request, tal: str = "", pretty: bool = False):
     """
     ### Files Lookup Query
     """
-    res = supabase.rpc(
-        'query_file',
-        {'tal': tal}
-    )
-    data = res.json()
+    data = await rpc('query_file', {'tal': tal})
     res = {"count": len(data), "data": data}
     if pretty:
-        data_res = json.dumps(res, indent=4)
+        data_res = orjson.dumps(res, option=orjson.OPT_INDENT_2)
     else:
-        data_res = json.dumps(res)
+        data_res = orjson.dumps(res)
 
     return Response(data_res, media_type="application/json")
 
 
-@app.get("/lookup", response_model=Result, response_description="The found ROA entry", )
+@app.get("/lookup", responses={200: {"model": Result, "description": "The found ROA entry"}})
 async def lookup(request: Request, prefix: str = "", asn: int = -1, tal: str = "", date: str = "", max_len: int = -1,
-                 limit: int = 100,
-                 page: int = 1, pretty: bool = False):
+                 limit: int = 100, page: Optional[int] = None, cursor: Optional[str] = None,
+                 include_next: bool = True, pretty: bool = False):
     """
     ### ROAs Lookup Query
 
@@ -140,7 +273,14 @@ async def lookup(request: Request, prefix: str = "", asn: int = -1, tal: str = "
     - `max_len`: filter results by the max_len value, e.g. `?max_len=24`
     - `limit`: limit the number of entries returns from the API. Default is `100`, and the backend support maximum of `10000` as the limit.
         - note: the maximum number of entries per ASN is around 4000.
-    - `page`: the results are paginated, you can specify page number with `page` parameter, value starting from 1.
+    - `cursor`: the results are paginated, pass the `next_cursor` value of the previous response to continue right
+    after its last entry. Without `cursor` (and `page`), the first page is returned. Where cursor pagination is not
+    available, `next_cursor` is always `null` and results are paginated with `page`.
+    - `page`: legacy offset-based pagination, you can specify page number with `page` parameter, value starting from 1.
+    Pages requested with `page` are linked with `page` only and never return a `next_cursor`. Ignored when `cursor` is
+    set. Prefer `cursor` for deep paging.
+    - `include_next`: if false, the `next_page` URL is not built and returned as `null`, default is `true`. Clients
+    paginating with `next_cursor` or `next_page_num` can set `?include_next=false`.
     - `pretty`: if true, the API returns prettified JSON objects, default is `false`. Example: `?pretty=true`.
 
     ### Response
@@ -150,8 +290,10 @@ async def lookup(request: Request, prefix: str = "", asn: int = -1, tal: str = "
         - default: 100
         - maximum: 10000
     - `count`: the number of entries returned from the API call
-    - `next_page_num`: the next page number
+    - `next_page_num`: the next page number (only set when paginating with `page`)
     - `next_page`: the **API URL** for accessing the next page of the entries
+    - `next_cursor`: the `cursor` value for accessing the next page of the entries (not set when paginating with
+    `page`)
     - `data`: the content of the lookup results
 
     The `data` field contains a number of ROA history entries, each has the following fields:
@@ -171,6 +313,7 @@ async def lookup(request: Request, prefix: str = "", asn: int = -1, tal: str = "
         "limit": 100,
         "count": 1,
         "next_page": null,
+        "next_cursor": null,
         "data": [
             {
                 "prefix": "8.8.8.0/24",
@@ -195,81 +338,201 @@ async def lookup(request: Request, prefix: str = "", asn: int = -1, tal: str = "
     """
 
     # parameter validations
-    if page < 1:
-        res = {"limit": limit, "count": 0, "next_page": None, "next_page_num": None, "data": [],
+    if page is not None and page < 1:
+        res = {"limit": limit, "count": 0, "next_page": None, "next_page_num": None, "next_cursor": None, "data": [],
                "error": "parameters validation failed: page>=1"}
-        return Response(json.dumps(res), media_type="application/json", status_code=400)
-    offset = (page - 1) * limit
-
-    res = supabase.rpc(
-        'query_history_2',
-        {'prefix': prefix, 'asn': asn, "nic": tal, "res_limit": limit, "date": date, 'max_len': max_len,
-         "res_offset": offset}
-    )
-    data = res.json()
+        return Response(orjson.dumps(res), media_type="application/json", status_code=400)
+    if cursor is not None and not cursor_pagination:
+        res = {"limit": limit, "count": 0, "next_page": None, "next_page_num": None, "next_cursor": None, "data": [],
+               "error": "parameters validation failed: cursor pagination is not available"}
+        return Response(orjson.dumps(res), media_type="application/json", status_code=400)
+    if limit < 1:
+        res = {"limit": limit, "count": 0, "next_page": None, "next_page_num": None, "next_cursor": None, "data": [],
+               "error": "parameters validation failed: limit>=1"}
+        return Response(orjson.dumps(res), media_type="application/json", status_code=400)
+
+    lookup_key = cache_key("lookup", {"prefix": prefix, "asn": asn, "tal": tal, "date": date, "max_len": max_len,
+                                      "limit": limit, "page": page, "cursor": cursor, "include_next": include_next,
+                                      "pretty": pretty})
+    cached = local_cache.get(lookup_key)
+    if cached is None:
+        cached = await redis_get(lookup_key)
+    if cached is not None:
+        return Response(cached, media_type="application/json")
+
+    rpc_params = {'prefix': prefix, 'asn': asn, "nic": tal, "res_limit": limit, "date": date, 'max_len': max_len}
+    # every page that hands out a cursor comes from `query_history_cursor`, which orders by the cursor's sort key
+    # `(tal, prefix, asn, max_len)`; the first page starts from a NULL key. `query_history_2` only serves legacy
+    # offset pages, which are linked by page number and never mixed with cursors.
+    use_cursor = cursor_pagination and (cursor is not None or page is None)
+    if not use_cursor and page is None:
+        page = 1
+    if cursor is not None:
+        try:
+            last_tal, last_prefix, last_asn, last_max_len = decode_cursor(cursor)
+        except ValueError:
+            res = {"limit": limit, "count": 0, "next_page": None, "next_page_num": None, "next_cursor": None,
+                   "data": [], "error": "parameters validation failed: invalid cursor"}
+            return Response(orjson.dumps(res), media_type="application/json", status_code=400)
+        rpc_params.update({"last_tal": last_tal, "last_prefix": last_prefix, "last_asn": last_asn,
+                           "last_max_len": last_max_len})
+        function = 'query_history_cursor'
+    elif use_cursor:
+        rpc_params.update({"last_tal": None, "last_prefix": None, "last_asn": None, "last_max_len": None})
+        function = 'query_history_cursor'
+    else:
+        rpc_params["res_offset"] = (page - 1) * limit
+        function = 'query_history_2'
+    if tal == '' and use_cursor:
+        data = await fetch_history_by_tal(function, rpc_params)
+    else:
+        data = await coalesce(cache_key(function, rpc_params), lambda: fetch_history(function, rpc_params))
 
     # check for error
     if 'message' in data:
-        res = {"limit": limit, "count": 0, "next_page": None, "next_page_num": None, "data": [],
+        res = {"limit": limit, "count": 0, "next_page": None, "next_page_num": None, "next_cursor": None, "data": [],
                "error": data['message']}
-        return Response(json.dumps(res), media_type="application/json", status_code=400)
-
-    new_data = []
-    for entry in data:
-
-        # update ranges
-        ranges = entry.pop('date_ranges')
-        new_ranges = []
-        for date_range in ranges:
-            new_ranges.append(range_to_array(date_range))
-        entry['date_ranges'] = new_ranges
-
-        new_data.append(entry)
+        return Response(orjson.dumps(res), media_type="application/json", status_code=400)
 
     length = len(data)
 
     new_url = None
     next_page_num = None
+    next_cursor = None
     if length >= limit:
-        new_url = BASEURL.rstrip("/") + "/lookup?"
-        params = []
-        if prefix != '':
-            params.append(f"prefix={prefix}")
-        if asn >= 0:
-            params.append(f"asn={asn}")
-        if tal != '':
-            params.append(f"tal={tal}")
-        if limit > 0:
-            params.append(f"limit={limit}")
-        if date != '':
-            params.append(f"date={date}")
-        if max_len >= 0:
-            params.append(f"max_len={max_len}")
-        if page > 0:
-            params.append(f"page={page + 1}")
+        if use_cursor:
+            last = data[-1]
+            next_cursor = encode_cursor(last['tal'], last['prefix'], last['asn'], last['max_len'])
+        else:
+            # page >= 1 is validated above
             next_page_num = page + 1
-        new_url += "&".join(params)
+        if include_next:
+            query = {k: v for k, v, used in (
+                ("prefix", prefix, prefix != ''), ("asn", asn, asn >= 0), ("tal", tal, tal != ''),
+                ("limit", limit, limit > 0), ("date", date, date != ''), ("max_len", max_len, max_len >= 0),
+            ) if used}
+            if use_cursor:
+                query["cursor"] = next_cursor
+            else:
+                query["page"] = next_page_num
+            new_url = f"{LOOKUP_URL}?{urllib.parse.urlencode(query)}"
+
+    res = {"limit": limit, "count": length, "next_page_num": next_page_num, "next_page": new_url,
+           "next_cursor": next_cursor}
+    body = []
+    return StreamingResponse(stream_lookup(res, data, pretty, body), media_type="application/json",
+                             background=BackgroundTask(cache_lookup, lookup_key, body))
+
+
+async def stream_lookup(res: dict, data: List[dict], pretty: bool, body: List[bytes]):
+    """
+    Encode a lookup response incrementally: the envelope first, then the entries in batches, then the trailing fields.
 
-    res = {"limit": limit, "count": length, "next_page_num": next_page_num, "next_page": new_url, "data": new_data,
-           "error": None}
+    The sent chunks are kept while the body stays within `CACHE_MAX_BODY_SIZE`. Once the stream completes, the joined
+    body is put into `body` for `cache_lookup`; larger or interrupted responses leave `body` empty.
+    """
     if pretty:
-        data_res = json.dumps(res, indent=4)
+        chunks = [orjson.dumps({**res, "data": data, "error": None}, option=orjson.OPT_INDENT_2)]
     else:
-        data_res = json.dumps(res)
+        chunks = iter_lookup_chunks(res, data)
 
-    return Response(data_res, media_type="application/json")
+    collected = []
+    size = 0
+    for chunk in chunks:
+        if collected is not None:
+            size += len(chunk)
+            if size <= CACHE_MAX_BODY_SIZE:
+                collected.append(chunk)
+            else:
+                # too large to be cached, stop holding on to the sent chunks
+                collected = None
+        yield chunk
+
+    if collected is not None:
+        body.append(b"".join(collected))
+
+
+async def cache_lookup(lookup_key: str, body: List[bytes]):
+    """
+    Store a lookup response body collected by `stream_lookup` in the caches, run as a background task after the
+    response has been sent.
+    """
+    if not body:
+        return
+    local_cache[lookup_key] = body[0]
+    await redis_set(lookup_key, body[0])
+
+
+def iter_lookup_chunks(res: dict, data: List[dict]) -> Iterator[bytes]:
+    yield orjson.dumps(res)[:-1] + b',"data":['
+    for i in range(0, len(data), STREAM_BATCH_SIZE):
+        chunk = b",".join(orjson.dumps(entry) for entry in data[i:i + STREAM_BATCH_SIZE])
+        yield chunk if i == 0 else b"," + chunk
+    yield b'],"error":null}'
 
 
-def range_to_array(date_range: str):
-    start_exclusive = False
-    end_exclusive = False
-    if date_range[0] == '(':
-        start_exclusive = True
-    if date_range[-1] == ')':
-        end_exclusive = True
-    start, end = date_range.lstrip("[(").rstrip("])").split(",")
-    if start_exclusive:
-        start = (datetime.datetime.strptime(start, '%Y-%M-%d') + datetime.timedelta(days=1)).strftime('%Y-%M-%d')
-    if end_exclusive:
-        end = (datetime.datetime.strptime(end, '%Y-%M-%d') - datetime.timedelta(days=1)).strftime('%Y-%M-%d')
-    return [start, end]
+async def fetch_history_by_tal(function: str, params: dict):
+    """
+    Query a lookup RPC function for every TAL in parallel instead of one query scanning all of them.
+
+    `query_history_cursor` orders by `(tal, prefix, asn, max_len)`, so the merged rows are sorted by TAL and cut at
+    `res_limit` to give the same page as the unfiltered query. The sort is stable and only on the TAL: rows of one TAL
+    keep the database's order, which is the one the cursor comparison uses (comparing prefixes as Python strings would
+    not match Postgres' ordering). Only used with `query_history_cursor`, offset-based pages cannot be split this way.
+    """
+    tals = TALS
+    if params['last_tal'] is not None:
+        # every entry of a TAL sorting before the cursor's TAL has been returned already
+        tals = [t for t in TALS if t >= params['last_tal']]
+
+    # each per-TAL call holds one pool connection while it runs, calls beyond the pool size wait for a free one
+    results = await asyncio.gather(*[
+        coalesce(cache_key(function, tal_params), functools.partial(fetch_history, function, tal_params))
+        for tal_params in ({**params, "nic": t} for t in tals)
+    ])
+
+    data = []
+    for result in results:
+        if 'message' in result:
+            return result
+        data.extend(result)
+    data.sort(key=lambda entry: entry['tal'])
+    return data[:params['res_limit']]
+
+
+async def fetch_history(function: str, params: dict):
+    """
+    Query ROA history entries from a lookup RPC function with their date ranges converted to inclusive arrays.
+    """
+    data = await rpc(function, params)
+    if 'message' not in data:
+        convert_date_ranges(data)
+    return data
+
+
+def encode_cursor(tal: str, prefix: str, asn: int, max_len: int) -> str:
+    """
+    Encode the sort key of the last returned ROA entry into an opaque pagination cursor.
+    """
+    return base64.urlsafe_b64encode(orjson.dumps([tal, prefix, asn, max_len])).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    Decode a pagination cursor back into its `(tal, prefix, asn, max_len)` sort key.
+
+    Raises `ValueError` if the cursor is malformed.
+    """
+    try:
+        key = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+    if not isinstance(key, list) or len(key) != 4:
+        raise ValueError(f"invalid cursor: {cursor}")
+    tal, prefix, asn, max_len = key
+    # bool is a subclass of int, but JSON true/false are not valid ASNs or max lengths
+    if not isinstance(tal, str) or not isinstance(prefix, str) \
+            or not isinstance(asn, int) or isinstance(asn, bool) \
+            or not isinstance(max_len, int) or isinstance(max_len, bool):
+        raise ValueError(f"invalid cursor: {cursor}")
+    return tal, prefix, asn, max_len
@@ -0,0 +1,49 @@
+"""
+Post-processing of ROA history entries returned by the lookup RPC functions.
+
+This module is compiled into a C extension with mypyc when building the Docker image, keep it fully type-annotated and
+free of imports from `main`. The pure-Python module is used as-is when it is not compiled.
+"""
+import datetime
+import functools
+from typing import Any, Dict, List, Tuple
+
+
+def convert_date_ranges(data: List[Dict[str, Any]]) -> None:
+    """
+    Convert the `date_ranges` of the entries in place into inclusive `[start, end]` arrays.
+    """
+    # update ranges, unless the RPC already returned them as inclusive `[start, end]` arrays
+    if not needs_range_conversion(data):
+        return
+    for entry in data:
+        entry['date_ranges'] = [range_to_array(date_range) for date_range in entry.pop('date_ranges')]
+
+
+def needs_range_conversion(data: List[Dict[str, Any]]) -> bool:
+    """
+    Check whether the `date_ranges` of the RPC results are still raw Postgres daterange strings.
+
+    The RPC functions can normalize ranges on the database side with `lower_inc`/`upper_inc`, in which case the ranges
+    arrive as `[start, end]` arrays and the Python conversion pass is skipped.
+    """
+    for entry in data:
+        for date_range in entry['date_ranges']:
+            return isinstance(date_range, str)
+    return False
+
+
+@functools.lru_cache(maxsize=16384)
+def range_to_array(date_range: str) -> Tuple[str, str]:
+    """
+    Convert a Postgres daterange string, e.g. `[2021-02-09,2022-01-27)`, into an inclusive `(start, end)` pair.
+
+    The same ranges repeat across many ROA entries, so conversions are memoized. The returned tuple is shared between
+    calls and serializes as a JSON array.
+    """
+    start, end = date_range[1:-1].split(",")
+    if date_range[0] == '(':
+        start = (datetime.datetime.strptime(start, '%Y-%m-%d') + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    if date_range[-1] == ')':
+        end = (datetime.datetime.strptime(end, '%Y-%m-%d') - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    return start, end
@@ -0,0 +1,383 @@
+import asyncio
+import base64
+import contextlib
+
+import asyncpg
+import orjson
+import pytest
+import redis.exceptions
+from cachetools import TTLCache
+from starlette.responses import StreamingResponse
+
+import main
+
+
+def test_cursor_round_trip():
+    cursor = main.encode_cursor("arin", "8.8.8.0/24", 15169, 24)
+    assert main.decode_cursor(cursor) == ("arin", "8.8.8.0/24", 15169, 24)
+
+
+@pytest.mark.parametrize("raw", [
+    b"not json",
+    b'{"a": 1, "b": 2, "c": 3, "d": 4}',
+    b'["arin", "8.8.8.0/24", 15169]',
+    b'["arin", "8.8.8.0/24", "x", {"a": 1}]',
+    b'["arin", "8.8.8.0/24", 15169, "24"]',
+    b'["arin", "8.8.8.0/24", true, 24]',
+    b'[null, "8.8.8.0/24", 15169, 24]',
+])
+def test_decode_cursor_rejects_malformed(raw):
+    with pytest.raises(ValueError):
+        main.decode_cursor(base64.urlsafe_b64encode(raw).decode())
+
+
+def test_decode_cursor_rejects_invalid_base64():
+    with pytest.raises(ValueError):
+        main.decode_cursor("!!!")
+
+
+def lookup_response(count):
+    res = {"limit": count, "count": count, "next_page_num": None, "next_page": None, "next_cursor": None}
+    data = [{"tal": "arin", "prefix": "8.8.8.0/24", "asn": i, "max_len": 24,
+             "date_ranges": [("2021-02-09", "2022-01-26")]} for i in range(count)]
+    return res, data
+
+
+@pytest.mark.parametrize("count", [0, 1, main.STREAM_BATCH_SIZE, main.STREAM_BATCH_SIZE + 1])
+def test_iter_lookup_chunks(count):
+    res, data = lookup_response(count)
+    body = b"".join(main.iter_lookup_chunks(res, data))
+
+    assert body == orjson.dumps({**res, "data": data, "error": None})
+
+
+async def collect_stream(stream, limit=None):
+    chunks = []
+    async for chunk in stream:
+        chunks.append(chunk)
+        if len(chunks) == limit:
+            await stream.aclose()
+            break
+    return b"".join(chunks)
+
+
+@pytest.mark.parametrize("pretty", [False, True])
+def test_stream_lookup_caches_sent_body(monkeypatch, pretty):
+    monkeypatch.setattr(main, "redis", None)
+    res, data = lookup_response(main.STREAM_BATCH_SIZE + 1)
+    body = []
+
+    async def run():
+        sent = await collect_stream(main.stream_lookup(res, data, pretty, body))
+        await main.cache_lookup("lookup:test-stream", body)
+        return sent
+
+    sent = asyncio.run(run())
+    assert orjson.loads(sent)["data"] == orjson.loads(orjson.dumps(data))
+    assert main.local_cache.pop("lookup:test-stream") == sent
+
+
+def test_stream_lookup_skips_large_bodies(monkeypatch):
+    monkeypatch.setattr(main, "redis", None)
+    monkeypatch.setattr(main, "CACHE_MAX_BODY_SIZE", 1024)
+    res, data = lookup_response(main.STREAM_BATCH_SIZE + 1)
+    body = []
+
+    asyncio.run(collect_stream(main.stream_lookup(res, data, False, body)))
+    assert body == []
+
+
+def test_stream_lookup_skips_interrupted_streams():
+    res, data = lookup_response(main.STREAM_BATCH_SIZE + 1)
+    body = []
+
+    asyncio.run(collect_stream(main.stream_lookup(res, data, False, body), limit=2))
+    assert body == []
+
+
+def fetch_tal_history(monkeypatch, rows, params):
+    calls = []
+
+    async def fetch_history(function, tal_params):
+        calls.append(tal_params["nic"])
+        result = rows.get(tal_params["nic"], [])
+        return result if isinstance(result, dict) else [dict(row) for row in result]
+
+    monkeypatch.setattr(main, "fetch_history", fetch_history)
+    return asyncio.run(main.fetch_history_by_tal("query_history_cursor", params)), calls
+
+
+def lookup_params(limit, last_tal=None):
+    return {"prefix": "", "asn": 15169, "nic": "", "res_limit": limit, "date": "", "max_len": -1,
+            "last_tal": last_tal, "last_prefix": None, "last_asn": None, "last_max_len": None}
+
+
+ROWS = {
+    # database order within a TAL, which differs from comparing prefixes as strings
+    "arin": [{"tal": "arin", "prefix": "9.0.0.0/8"}, {"tal": "arin", "prefix": "10.0.0.0/8"}],
+    "afrinic": [{"tal": "afrinic", "prefix": "41.0.0.0/8"}],
+    "ripencc": [{"tal": "ripencc", "prefix": "2.0.0.0/8"}],
+}
+
+
+def test_fetch_history_by_tal_merge_order(monkeypatch):
+    data, calls = fetch_tal_history(monkeypatch, ROWS, lookup_params(limit=3))
+
+    assert sorted(calls) == main.TALS
+    assert [(e["tal"], e["prefix"]) for e in data] == [
+        ("afrinic", "41.0.0.0/8"), ("arin", "9.0.0.0/8"), ("arin", "10.0.0.0/8"),
+    ]
+
+
+def test_fetch_history_by_tal_skips_tals_before_cursor(monkeypatch):
+    data, calls = fetch_tal_history(monkeypatch, ROWS, lookup_params(limit=10, last_tal="arin"))
+
+    assert sorted(calls) == ["arin", "lacnic", "ripencc"]
+    assert [e["tal"] for e in data] == ["arin", "arin", "ripencc"]
+
+
+def test_fetch_history_by_tal_returns_errors(monkeypatch):
+    data, _ = fetch_tal_history(monkeypatch, {**ROWS, "apnic": {"message": "boom"}}, lookup_params(limit=3))
+
+    assert data == {"message": "boom"}
+
+
+def call_lookup(monkeypatch, rows, **params):
+    """
+    Call the `/lookup` handler with a stubbed database, returning the status code and the decoded body.
+    """
+    calls = []
+
+    async def rpc(function, rpc_params):
+        calls.append((function, rpc_params))
+        result = rows(rpc_params) if callable(rows) else rows
+        return result if isinstance(result, dict) else [dict(row) for row in result]
+
+    async def run():
+        response = await main.lookup(None, **params)
+        if isinstance(response, StreamingResponse):
+            return response.status_code, b"".join([chunk async for chunk in response.body_iterator])
+        return response.status_code, response.body
+
+    monkeypatch.setattr(main, "rpc", rpc)
+    monkeypatch.setattr(main, "redis", None)
+    monkeypatch.setattr(main, "local_cache", TTLCache(maxsize=1024 * 1024, ttl=60, getsizeof=len))
+    status, body = asyncio.run(run())
+    return status, orjson.loads(body), calls
+
+
+def roa_rows(count, tal="arin"):
+    return [{"tal": tal, "prefix": f"10.{i}.0.0/16", "asn": 15169, "max_len": 24,
+             "date_ranges": ["[2021-02-09,2022-01-27)"]} for i in range(count)]
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_lookup_rejects_limit_below_one(monkeypatch, limit):
+    status, res, calls = call_lookup(monkeypatch, [], tal="arin", limit=limit)
+
+    assert status == 400
+    assert res["error"] == "parameters validation failed: limit>=1"
+    assert res["data"] == [] and res["next_cursor"] is None
+    assert calls == []
+
+
+def test_lookup_rejects_page_below_one(monkeypatch):
+    status, res, calls = call_lookup(monkeypatch, [], tal="arin", page=0)
+
+    assert status == 400
+    assert calls == []
+
+
+def test_lookup_page(monkeypatch):
+    status, res, calls = call_lookup(monkeypatch, roa_rows(2), tal="arin", limit=2, page=2)
+
+    assert status == 200
+    assert res["count"] == 2 and res["next_page_num"] == 3 and res["next_cursor"] is None
+    assert res["data"][0]["date_ranges"] == [["2021-02-09", "2022-01-26"]]
+    assert calls[0][0] == "query_history_2" and calls[0][1]["res_offset"] == 2
+
+
+def test_lookup_last_page(monkeypatch):
+    status, res, _ = call_lookup(monkeypatch, roa_rows(1), tal="arin", limit=2, page=1)
+
+    assert status == 200
+    assert res["count"] == 1 and res["next_page"] is None and res["next_page_num"] is None
+
+
+def test_lookup_without_cursor_pagination(monkeypatch):
+    monkeypatch.setattr(main, "cursor_pagination", False)
+    status, res, calls = call_lookup(monkeypatch, roa_rows(2), limit=2)
+
+    assert status == 200
+    assert res["next_page_num"] == 2 and res["next_cursor"] is None
+    assert [(function, params["nic"], params["res_offset"]) for function, params in calls] == [
+        ("query_history_2", "", 0),
+    ]
+
+    status, res, calls = call_lookup(monkeypatch, roa_rows(2), limit=2, cursor=main.encode_cursor("arin", "", 0, 0))
+    assert status == 400
+    assert calls == []
+
+
+def test_lookup_cursor_pages(monkeypatch):
+    monkeypatch.setattr(main, "cursor_pagination", True)
+    status, res, calls = call_lookup(monkeypatch, roa_rows(2), tal="arin", limit=2)
+
+    assert status == 200
+    assert res["next_page_num"] is None
+    assert main.decode_cursor(res["next_cursor"]) == ("arin", "10.1.0.0/16", 15169, 24)
+    assert calls[0][0] == "query_history_cursor" and calls[0][1]["last_tal"] is None
+
+    status, res, calls = call_lookup(monkeypatch, roa_rows(1), tal="arin", limit=2, cursor=res["next_cursor"])
+    assert status == 200
+    assert res["count"] == 1 and res["next_cursor"] is None
+    assert calls[0][1]["last_prefix"] == "10.1.0.0/16"
+
+
+def test_lookup_unfiltered_cursor_page_fans_out(monkeypatch):
+    monkeypatch.setattr(main, "cursor_pagination", True)
+    status, res, calls = call_lookup(monkeypatch, lambda params: roa_rows(1, tal=params["nic"]), limit=3)
+
+    assert status == 200
+    assert sorted(params["nic"] for _, params in calls) == main.TALS
+    assert [e["tal"] for e in res["data"]] == ["afrinic", "apnic", "arin"]
+
+
+def test_lookup_next_page_escapes_parameters(monkeypatch):
+    monkeypatch.setattr(main, "cursor_pagination", False)
+    _, res, _ = call_lookup(monkeypatch, roa_rows(2), prefix="10.0.0.0/8", tal="arin", limit=2, page=1)
+
+    assert res["next_page"] == f"{main.LOOKUP_URL}?prefix=10.0.0.0%2F8&tal=arin&limit=2&page=2"
+
+    monkeypatch.setattr(main, "cursor_pagination", True)
+    _, res, _ = call_lookup(monkeypatch, roa_rows(2), prefix="10.0.0.0/8", tal="arin", limit=2)
+
+    assert res["next_cursor"].endswith("=")
+    escaped = res["next_cursor"].replace("=", "%3D")
+    assert res["next_page"] == f"{main.LOOKUP_URL}?prefix=10.0.0.0%2F8&tal=arin&limit=2&cursor={escaped}"
+
+
+def test_lookup_without_next_page_url(monkeypatch):
+    monkeypatch.setattr(main, "cursor_pagination", False)
+    _, res, _ = call_lookup(monkeypatch, roa_rows(2), tal="arin", limit=2, page=1, include_next=False)
+
+    assert res["next_page"] is None and res["next_page_num"] == 2
+
+    monkeypatch.setattr(main, "cursor_pagination", True)
+    _, res, _ = call_lookup(monkeypatch, roa_rows(2), tal="arin", limit=2, include_next=False)
+
+    assert res["next_page"] is None
+    assert main.decode_cursor(res["next_cursor"]) == ("arin", "10.1.0.0/16", 15169, 24)
+
+
+class StubPool:
+    def __init__(self, result):
+        self.result = result
+        self.queries = []
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    async def fetchval(self, query, *args):
+        self.queries.append((query, args))
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+@pytest.mark.parametrize("error", [
+    asyncpg.exceptions.UndefinedFunctionError("function query_history_2 does not exist"),
+    # asyncpg's client-side argument error is a ValueError
+    asyncpg.exceptions._base.DataError("invalid input for query argument $1"),
+])
+def test_rpc_maps_errors_to_message(monkeypatch, error):
+    monkeypatch.setattr(main, "db_pool", StubPool(error))
+
+    assert asyncio.run(main.rpc("query_history_2", {"prefix": ""})) == {"message": str(error)}
+
+
+def test_rpc(monkeypatch):
+    pool = StubPool('[{"tal": "arin"}]')
+    monkeypatch.setattr(main, "db_pool", pool)
+
+    assert asyncio.run(main.rpc("query_file", {"tal": "arin", "date": ""})) == [{"tal": "arin"}]
+    assert pool.queries == [
+        ("SELECT coalesce(json_agg(t), '[]'::json) FROM query_file(\"tal\" => $1, \"date\" => $2) t", ("arin", "")),
+    ]
+
+
+class StubRedis:
+    def __init__(self, error=None):
+        self.error = error
+        self.store = {}
+
+    async def get(self, key):
+        if self.error is not None:
+            raise self.error
+        return self.store.get(key)
+
+    async def set(self, key, value, ex=None):
+        if self.error is not None:
+            raise self.error
+        self.store[key] = value
+
+
+def test_redis_round_trip(monkeypatch):
+    stub = StubRedis()
+    monkeypatch.setattr(main, "redis", stub)
+
+    asyncio.run(main.redis_set("key", b"body"))
+
+    assert stub.store == {"key": b"body"}
+    assert asyncio.run(main.redis_get("key")) == b"body"
+
+
+@pytest.mark.parametrize("error", [
+    redis.exceptions.ConnectionError("connection refused"),
+    asyncio.TimeoutError(),
+    OSError("network unreachable"),
+])
+def test_redis_failure_is_a_miss(monkeypatch, error):
+    monkeypatch.setattr(main, "redis", StubRedis(error))
+
+    assert asyncio.run(main.redis_get("key")) is None
+    asyncio.run(main.redis_set("key", b"body"))
+
+
+def test_coalesce_shares_one_call(monkeypatch):
+    monkeypatch.setattr(main, "inflight", {})
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return [{"tal": "arin"}]
+
+    async def run():
+        results = await asyncio.gather(main.coalesce("key", fetch), main.coalesce("key", fetch))
+        assert "key" not in main.inflight
+        return results
+
+    first, second = asyncio.run(run())
+
+    assert first is second
+    assert calls == [1]
+    assert main.inflight == {}
+
+
+def test_coalesce_survives_a_cancelled_caller(monkeypatch):
+    monkeypatch.setattr(main, "inflight", {})
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return "rows"
+
+    async def run():
+        cancelled = asyncio.ensure_future(main.coalesce("key", fetch))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await main.coalesce("key", fetch)
+
+    assert asyncio.run(run()) == "rows"
+    assert main.inflight == {}
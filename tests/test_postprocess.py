@@ -0,0 +1,28 @@
+import pytest
+
+from postprocess import convert_date_ranges, range_to_array
+
+
+@pytest.mark.parametrize("date_range, expected", [
+    ("[2021-02-09,2022-01-27]", ("2021-02-09", "2022-01-27")),
+    ("[2021-02-09,2022-01-27)", ("2021-02-09", "2022-01-26")),
+    # exclusive bounds shifting across month, leap day and year boundaries
+    ("[2021-02-01,2021-03-01)", ("2021-02-01", "2021-02-28")),
+    ("[2020-02-01,2020-03-01)", ("2020-02-01", "2020-02-29")),
+    ("(2021-01-31,2021-03-01]", ("2021-02-01", "2021-03-01")),
+    ("(2020-12-31,2022-01-01)", ("2021-01-01", "2021-12-31")),
+])
+def test_range_to_array(date_range, expected):
+    assert range_to_array(date_range) == expected
+
+
+def test_convert_date_ranges():
+    data = [{"tal": "arin", "date_ranges": ["[2021-02-01,2021-03-01)", "[2021-04-01,2021-04-02)"]}]
+    convert_date_ranges(data)
+    assert data[0]["date_ranges"] == [("2021-02-01", "2021-02-28"), ("2021-04-01", "2021-04-01")]
+
+
+def test_convert_date_ranges_skips_normalized_ranges():
+    data = [{"tal": "arin", "date_ranges": []}, {"tal": "arin", "date_ranges": [["2021-02-01", "2021-02-28"]]}]
+    convert_date_ranges(data)
+    assert data[1]["date_ranges"] == [["2021-02-01", "2021-02-28"]]